@@ -21,21 +21,49 @@ Diagnóstico:
 - JSON_count = cuántos productos devolvió
 """
 
-import re
 import io
 import csv
 import time
-from typing import List, Dict, Optional, Tuple
-from urllib.parse import urljoin
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Dict, Optional, Tuple
+from urllib.parse import quote, urljoin
 from json import JSONDecodeError
 
+import orjson
+import pandas as pd
 import requests
 import cloudscraper  # type: ignore
 import streamlit as st
+from urllib3.util.retry import Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ---------- Config ----------
 DOMAIN = "https://simple.ripley.cl"
 TIMEOUT = 20
+SESSION_TTL = 3600  # seg. que se reutiliza la sesión (cookies Cloudflare, keep-alive)
+LOOKUP_TTL = 3600   # seg. que se reutiliza un producto encontrado entre ejecuciones
+LOOKUP_MAX_ENTRIES = 5000
+UI_REFRESH = 0.25   # seg. mínimos entre actualizaciones de progreso
+MAX_WORKERS = 4  # SKUs consultados en paralelo por defecto (I/O-bound)
+MAX_WORKERS_LIMIT = 16
+POOL_SIZE = 32   # conexiones keep-alive por host (>= MAX_WORKERS_LIMIT)
+RETRY_AFTER_MAX = TIMEOUT  # seg. máximos que se acata un Retry-After
+
+class CappedRetry(Retry):
+    """
+    Retry que respeta Retry-After (429) pero lo acota a RETRY_AFTER_MAX:
+    urllib3 lo acepta hasta 6 h y TIMEOUT no limita esa espera.
+    """
+
+    def get_retry_after(self, response):  # type: ignore[override]
+        seconds = super().get_retry_after(response)
+        return None if seconds is None else min(seconds, RETRY_AFTER_MAX)
+
+# 503 queda fuera a propósito: es el desafío de Cloudflare y lo resuelve
+# cloudscraper (o is_cloudflare_block), no un reintento ciego.
+RETRIES = CappedRetry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 504),
+                      raise_on_status=False)
 HEADERS = {
     "User-Agent": (
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
@@ -45,23 +73,67 @@ HEADERS = {
     "Accept-Language": "es-CL,es;q=0.9,en;q=0.8",
 }
 
-MISC_PAT = re.compile(r"(otros|miscel|varios|variedad|otros productos)", re.IGNORECASE)
+# subcadenas (en minúsculas) que delatan una categoría "cajón de sastre"
+MISC_TOKENS = ("otros", "miscel", "varios", "variedad")
 HOME_NOISE = {"home", "inicio", "búsqueda", "busqueda", "resultados", "search", "results"}
+CRUMB_SEPARATORS = frozenset({">", "/", "|", "›", "»", "•"})
+CRUMB_NOISE = CRUMB_SEPARATORS | HOME_NOISE  # separadores + ruido, una sola búsqueda
 
 # ---------- Utils ----------
-def candidate_skus(s: str) -> List[str]:
+def candidate_skus(s: str) -> Iterator[str]:
     s = s.strip()
-    cands = [s]
+    yield s
     if "-" in s:
-        base = s.split("-")[0].strip()
-        if base and base not in cands:
-            cands.append(base)
-    return cands
+        base = s.split("-", 1)[0].strip()
+        if base and base != s:
+            yield base
+
+class BatchCancelled(Exception):
+    """El lote se detuvo (Stop o rerun) mientras un hilo esperaba turno."""
+
+class RateLimiter:
+    """
+    Espaciado mínimo entre requests HTTP, compartido por todos los hilos: cada
+    llamada reserva el siguiente turno bajo lock y espera fuera de él.
+    Tras stop(), wait() lanza BatchCancelled: los SKUs en curso no hacen
+    más requests.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+        self._stopped = threading.Event()
 
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def wait(self) -> None:
+        if self._stopped.is_set():
+            raise BatchCancelled()
+        if self.interval <= 0:
+            return
+        with self._lock:
+            slot = max(self._next, time.monotonic())
+            self._next = slot + self.interval
+        pause = slot - time.monotonic()
+        # esperar sobre el Event para despertar apenas se detenga el lote
+        if pause > 0 and self._stopped.wait(pause):
+            raise BatchCancelled()
+
+@st.cache_resource(ttl=SESSION_TTL, show_spinner=False)
 def new_session() -> requests.Session:
-    """Return a preconfigured session able to bypass Cloudflare."""
+    """
+    Return a preconfigured session able to bypass Cloudflare.
+    Cached across reruns so cookies and keep-alive connections are reused.
+    """
     s = cloudscraper.create_scraper()
     s.headers.update(HEADERS)
+    # reconfigurar los adapters montados (no reemplazarlos) para no perder
+    # el TLS de cloudscraper: pool más grande + reintentos con backoff
+    for adapter in s.adapters.values():
+        adapter.max_retries = RETRIES
+        adapter.init_poolmanager(POOL_SIZE, POOL_SIZE)
     # warm session with homepage to obtain necessary cookies
     try:
         s.get(DOMAIN, timeout=TIMEOUT)
@@ -69,24 +141,43 @@ def new_session() -> requests.Session:
         pass
     return s
 
-def session_get_json(url: str, session: requests.Session) -> Optional[object]:
+def _is_json(r: requests.Response) -> bool:
+    return r.headers.get("Content-Type", "").startswith("application/json")
+
+def is_cloudflare_block(r: requests.Response) -> bool:
+    """
+    403 o página de desafío de Cloudflare. El cuerpo sólo se revisa si no es
+    JSON, y como bytes: sin r.text (detección de charset) ni copia a minúsculas.
+    """
+    if r.status_code == 403:
+        return True
+    if _is_json(r):
+        return False
+    body = r.content
+    return b"cloudflare" in body or b"Cloudflare" in body
+
+def session_get_json(url: str, session: requests.Session,
+                     limiter: Optional[RateLimiter] = None) -> Optional[object]:
     """GET a URL and return JSON, surfacing Cloudflare blocks clearly."""
+    # el turno se toma sólo aquí, antes de cada GET: los aciertos de caché no esperan
+    wait = limiter.wait if limiter is not None else (lambda: None)
     try:
+        wait()
         r = session.get(url, timeout=TIMEOUT)
     except requests.RequestException as e:
         st.warning(f"Error de red al solicitar {url}: {e}")
         return None
 
-    body_lower = r.text.lower() if r.text else ""
-    if r.status_code == 403 or "cloudflare" in body_lower:
+    if is_cloudflare_block(r):
         # try refreshing cookies once by hitting the homepage and retry
         try:
+            wait()
             session.get(DOMAIN, timeout=TIMEOUT)
+            wait()
             r = session.get(url, timeout=TIMEOUT)
-            body_lower = r.text.lower() if r.text else ""
         except requests.RequestException:
             pass
-        if r.status_code == 403 or "cloudflare" in body_lower:
+        if is_cloudflare_block(r):
             st.error(
                 f"Cloudflare bloqueó la solicitud ({r.status_code}) para {url}. Revisa IP o cookies."
             )
@@ -94,11 +185,12 @@ def session_get_json(url: str, session: requests.Session) -> Optional[object]:
     if r.status_code != 200:
         st.warning(f"Solicitud falló ({r.status_code}) para {url}")
         return None
-    if not r.headers.get("Content-Type", "").startswith("application/json"):
+    if not _is_json(r):
         st.warning(f"Contenido no JSON devuelto ({r.status_code}) para {url}")
         return None
     try:
-        return r.json()
+        # orjson decodifica directo desde bytes (sin pasar por r.text)
+        return orjson.loads(r.content)
     except JSONDecodeError as e:
         st.warning(f"Error al decodificar JSON ({r.status_code}) {url}: {e}")
         return None
@@ -112,10 +204,8 @@ def normalize_crumbs(raw_crumbs: List[str]) -> Tuple[List[str], bool]:
         if not t:
             continue
         had_any = True
-        # separadores típicos
-        if t in {">", "/", "|", "›", "»", "•"}:
-            continue
-        if t.lower() in HOME_NOISE:
+        # separadores típicos y Home/Inicio
+        if t.lower() in CRUMB_NOISE:
             continue
         if not cleaned or cleaned[-1] != t:
             cleaned.append(t)
@@ -125,11 +215,21 @@ def normalize_crumbs(raw_crumbs: List[str]) -> Tuple[List[str], bool]:
 def is_catalogado_from_limpios(crumbs_limpios: List[str]) -> bool:
     if len(crumbs_limpios) < 2:
         return False
-    if any(MISC_PAT.search(c) for c in crumbs_limpios):
+    # una sola pasada en minúsculas; '\x1f' evita coincidencias entre niveles
+    joined = "\x1f".join(crumbs_limpios).lower()
+    if any(tok in joined for tok in MISC_TOKENS):
         return False
     return True
 
 # ---------- VTEX parsing ----------
+# Endpoints de búsqueda en orden de preferencia (se formatean con el SKU).
+VTEX_SEARCH_PATH = "/api/catalog_system/pub/products/search/"
+VTEX_ENDPOINTS = tuple(VTEX_SEARCH_PATH + q for q in (
+    "?fq=alternateIds_RefId:{sku}",
+    "?fq=skuId:{sku}",
+    "?ft={sku}",
+))
+
 def _split_catpath(catpath: str) -> List[str]:
     """
     Catpath típico de VTEX: '/Moda/Mujer/Bottoms/'
@@ -195,19 +295,18 @@ def build_pdp_url_from_vtex(prod: dict) -> Optional[str]:
         return urljoin(DOMAIN, path)
     return None
 
-def vtex_lookup_for_sku(sku: str, session: requests.Session) -> Tuple[Optional[str], List[str], str, int]:
+VtexLookup = Tuple[Optional[str], List[str], str, int]
+
+def vtex_lookup_for_sku(sku: str, session: requests.Session,
+                        limiter: Optional[RateLimiter] = None) -> VtexLookup:
     """
     Prueba varios endpoints VTEX para obtener el producto y categorías.
     Devuelve: (pdp_url, crumbs_raw, endpoint_usado, json_count)
     """
-    endpoints = [
-        f"/api/catalog_system/pub/products/search/?fq=alternateIds_RefId:{sku}",
-        f"/api/catalog_system/pub/products/search/?fq=skuId:{sku}",
-        f"/api/catalog_system/pub/products/search/?ft:{sku}",
-    ]
-    for ep in endpoints:
-        url = urljoin(DOMAIN, ep)
-        data = session_get_json(url, session)
+    q = quote(sku, safe="")  # SKUs con espacios, '+', '&' o '#' no rompen la query
+    for tmpl in VTEX_ENDPOINTS:
+        ep = tmpl.format(sku=q)
+        data = session_get_json(DOMAIN + ep, session, limiter)
         if isinstance(data, list) and len(data) > 0:
             prod = data[0]
             crumbs = extract_categories_from_vtex_product(prod)
@@ -215,10 +314,97 @@ def vtex_lookup_for_sku(sku: str, session: requests.Session) -> Tuple[Optional[s
             return pdp, crumbs, ep, len(data)
     return None, [], "none", 0
 
+class LookupStore:
+    """
+    Lookups VTEX con producto encontrado, con TTL, compartidos entre reruns.
+    Sólo se guardan aciertos: un error de red o un bloqueo no queda cacheado.
+    """
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data: Dict[str, Tuple[float, VtexLookup]] = {}
+
+    def get(self, sku: str) -> Optional[VtexLookup]:
+        with self._lock:
+            entry = self._data.get(sku)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._data[sku]  # vencida: liberar ya, no esperar al desborde
+                return None
+        return entry[1]
+
+    def put(self, sku: str, hit: VtexLookup) -> None:
+        with self._lock:
+            self._data.pop(sku, None)
+            if len(self._data) >= self.max_entries:
+                # el más antiguo es el primero en orden de inserción
+                self._data.pop(next(iter(self._data)))
+            self._data[sku] = (time.monotonic(), hit)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+@st.cache_resource(show_spinner=False)
+def lookup_store() -> LookupStore:
+    return LookupStore(LOOKUP_TTL, LOOKUP_MAX_ENTRIES)
+
+# (lookup, viene_de_ejecución_anterior)
+CachedLookup = Tuple[VtexLookup, bool]
+
+def cached_vtex_lookup(sku: str, session: requests.Session,
+                       cache: Optional[Dict[str, CachedLookup]],
+                       store: Optional[LookupStore] = None,
+                       limiter: Optional[RateLimiter] = None) -> CachedLookup:
+    """
+    vtex_lookup_for_sku memoizado por SKU candidato:
+      - cache: dict del lote; variantes como 'X-4' y 'X' comparten la
+        consulta de 'X' (incluye "no encontrado").
+      - store: aciertos de ejecuciones anteriores (ver LookupStore).
+    El flag indica si el dato salió del store, para marcarlo en el resultado.
+    """
+    if cache is not None and sku in cache:
+        return cache[sku]
+    hit = store.get(sku) if store is not None else None
+    from_store = hit is not None
+    if hit is None:
+        hit = vtex_lookup_for_sku(sku, session, limiter)
+        if store is not None and hit[3] > 0:
+            store.put(sku, hit)
+    if cache is not None:
+        cache[sku] = (hit, from_store)
+    return hit, from_store
+
 # ---------- Main logic ----------
-def analyze_sku(sku: str, sess: requests.Session) -> Dict[str, str]:
+# Plantilla de resultado: cada rama sólo sobreescribe lo que cambia.
+# El orden de las claves define también las columnas del CSV.
+RESULT_TEMPLATE: Dict[str, str] = {
+    "SKU": "",
+    "Catalogado": "No",
+    "Breadcrumb_crudo": "",
+    "Breadcrumb_limpio": "",
+    "FuenteTaxonomía": "none",
+    "EndpointVTEX": "none",
+    "URL": "",
+    "Observación": "",
+    "Modo": "vtex",
+    "JSON_count": "0",
+    "HTML_len": "-",  # no usamos HTML
+}
+CSV_COLS = list(RESULT_TEMPLATE)
+
+def analyze_sku(sku: str, sess: requests.Session,
+                cache: Optional[Dict[str, CachedLookup]] = None,
+                store: Optional[LookupStore] = None,
+                limiter: Optional[RateLimiter] = None) -> Dict[str, str]:
     for cand in candidate_skus(sku):
-        pdp_url, crumbs_raw, endpoint, n = vtex_lookup_for_sku(cand, sess)
+        (pdp_url, crumbs_raw, endpoint, n), from_store = cached_vtex_lookup(
+            cand, sess, cache, store, limiter)
+        # datos de una ejecución anterior: visible en la tabla, no silencioso
+        modo = "vtex-cache" if from_store else "vtex"
         if crumbs_raw:
             crumbs_limpios, solo_home = normalize_crumbs(crumbs_raw)
             if is_catalogado_from_limpios(crumbs_limpios):
@@ -232,6 +418,7 @@ def analyze_sku(sku: str, sess: requests.Session) -> Dict[str, str]:
                     obs = "Faltan niveles o hay misc."
                 catalogado = "No"
             return {
+                **RESULT_TEMPLATE,
                 "SKU": sku,
                 "Catalogado": catalogado,
                 "Breadcrumb_crudo": " > ".join(crumbs_raw),
@@ -240,50 +427,35 @@ def analyze_sku(sku: str, sess: requests.Session) -> Dict[str, str]:
                 "EndpointVTEX": endpoint,
                 "URL": pdp_url or "",
                 "Observación": obs,
-                "Modo": "vtex",
+                "Modo": modo,
                 "JSON_count": str(n),
-                "HTML_len": "-"  # no usamos HTML
             }
         # si no hubo crumbs pero hubo respuesta, igual reportamos
         if endpoint != "none" and n > 0:
             return {
+                **RESULT_TEMPLATE,
                 "SKU": sku,
-                "Catalogado": "No",
-                "Breadcrumb_crudo": "",
-                "Breadcrumb_limpio": "",
                 "FuenteTaxonomía": "vtex_api",
                 "EndpointVTEX": endpoint,
                 "URL": pdp_url or "",
                 "Observación": "Respuesta sin categorías en JSON",
-                "Modo": "vtex",
+                "Modo": modo,
                 "JSON_count": str(n),
-                "HTML_len": "-"
             }
 
     # ningún endpoint devolvió producto
-    return {
-        "SKU": sku,
-        "Catalogado": "No",
-        "Breadcrumb_crudo": "",
-        "Breadcrumb_limpio": "",
-        "FuenteTaxonomía": "none",
-        "EndpointVTEX": "none",
-        "URL": "",
-        "Observación": "No encontrado / sin datos",
-        "Modo": "vtex",
-        "JSON_count": "0",
-        "HTML_len": "-"
-    }
+    return {**RESULT_TEMPLATE, "SKU": sku, "Observación": "No encontrado / sin datos"}
 
 def to_csv(rows: List[Dict[str, str]]) -> bytes:
-    buf = io.StringIO()
-    cols = ["SKU","Catalogado","Breadcrumb_crudo","Breadcrumb_limpio","FuenteTaxonomía",
-            "EndpointVTEX","URL","Observación","Modo","JSON_count","HTML_len"]
-    w = csv.DictWriter(buf, fieldnames=cols)
+    # escribir directo a bytes: evita materializar el CSV como str y luego codificarlo
+    buf = io.BytesIO()
+    tw = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    # DictWriter ya rellena claves faltantes con "" (restval); ignora las extra
+    w = csv.DictWriter(tw, fieldnames=CSV_COLS, extrasaction="ignore")
     w.writeheader()
-    for r in rows:
-        w.writerow({k: r.get(k, "") for k in cols})
-    return buf.getvalue().encode("utf-8")
+    w.writerows(rows)
+    tw.detach()
+    return buf.getvalue()
 
 # ---------- UI ----------
 st.set_page_config(page_title="Validador Catalogación (VTEX API)", layout="wide")
@@ -297,36 +469,71 @@ with colA:
                        placeholder="MPM10002913810-4\nMPM10002913810\n7808774708749")
     run = st.button("Validar catalogación", type="primary")
 with colB:
-    delay = st.slider("Retardo entre SKUs (seg.)", 0.0, 2.0, 0.3, 0.1,
-                      help="Evita rate-limit de la API pública.")
+    delay = st.slider("Retardo entre consultas (seg.)", 0.0, 2.0, 0.3, 0.1,
+                      help="Espacio mínimo entre requests a la API pública (evita "
+                           "rate-limit). Los productos ya en caché no esperan.")
+    workers = st.slider("Consultas en paralelo", 1, MAX_WORKERS_LIMIT, MAX_WORKERS, 1,
+                        help="SKUs consultados a la vez. Bájalo si aparecen bloqueos o 429.")
     only_no = st.toggle("Mostrar sólo NO catalogados", value=False)
+    if st.button("Limpiar caché de productos",
+                 help="Olvida los productos encontrados en ejecuciones anteriores "
+                      "(filas con Modo='vtex-cache')."):
+        lookup_store().clear()
+        st.toast("Caché limpiada")
 
 if run and raw.strip():
     skus = [s.strip() for s in raw.splitlines() if s.strip()]
-    results: List[Dict[str, str]] = []
+    unique = list(dict.fromkeys(skus))  # SKUs repetidos se consultan una vez
+    by_sku: Dict[str, Dict[str, str]] = {}
     progress = st.progress(0)
     status = st.empty()
 
     sess = new_session()
+    lookups: Dict[str, CachedLookup] = {}
+    store = lookup_store()
+    ctx = get_script_run_ctx()
+
+    def _attach_ctx() -> None:
+        # los hilos del pool necesitan el contexto para usar st.warning/st.error
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+    # el retardo se aplica entre requests HTTP del lote completo, no por hilo
+    limiter = RateLimiter(delay)
+
+    # sin `with`: su __exit__ espera a que termine toda la cola. Stop/rerun
+    # llegan como excepción sólo a este hilo; al salir se cancela lo pendiente
+    # y los hilos en curso se cortan en su próximo request.
+    ex = ThreadPoolExecutor(max_workers=workers, initializer=_attach_ctx)
     try:
-        for i, sku in enumerate(skus, start=1):
-            status.info(f"Procesando {i}/{len(skus)}: {sku}")
-            res = analyze_sku(sku, sess)
-            results.append(res)
-            progress.progress(i/len(skus))
-            if delay:
-                time.sleep(delay)
+        futures = {ex.submit(analyze_sku, sku, sess, lookups, store, limiter): sku
+                   for sku in unique}
+        # avanzar a medida que terminan, sin esperar al SKU más lento;
+        # el frontend se actualiza como máximo cada UI_REFRESH seg.
+        last_ui = 0.0
+        for i, fut in enumerate(as_completed(futures), start=1):
+            sku = futures[fut]
+            by_sku[sku] = fut.result()
+            now = time.monotonic()
+            if now - last_ui >= UI_REFRESH or i == len(unique):
+                status.info(f"Procesado {i}/{len(unique)}: {sku}")
+                progress.progress(i/len(unique))
+                last_ui = now
     finally:
-        sess.close()
+        limiter.stop()
+        ex.shutdown(wait=False, cancel_futures=True)
+    # una fila por SKU pegado, en el orden original (incluye repetidos)
+    results: List[Dict[str, str]] = [by_sku[sku] for sku in skus]
 
     status.success("Listo ✅")
 
-    rows = results if not only_no else [r for r in results if r["Catalogado"] != "Sí"]
+    # un único DataFrame para tabla, filtro, métricas y diagnóstico
+    df = pd.DataFrame.from_records(results, columns=CSV_COLS)
+    is_si = df["Catalogado"] == "Sí"
     st.subheader("Resultados")
-    st.dataframe(rows, use_container_width=True)
+    st.dataframe(df[~is_si] if only_no else df, use_container_width=True)
 
-    total = len(results)
-    si = sum(1 for r in results if r["Catalogado"] == "Sí")
+    total = len(df)
+    si = int(is_si.sum())
     no = total - si
     c1, c2, c3 = st.columns(3)
     c1.metric("Total SKUs", total)
@@ -339,5 +546,8 @@ if run and raw.strip():
     with st.expander("Diagnóstico (avanzado)"):
         st.write("Si EndpointVTEX='none' → la API no devolvió datos para ese SKU "
                  "(prueba sin sufijo después de '-' o aumenta delay).")
+        st.write(f"Si Modo='vtex-cache' → categorías reutilizadas de una ejecución "
+                 f"anterior (hasta {LOOKUP_TTL // 60} min); usa 'Limpiar caché de "
+                 "productos' para revalidar contra VTEX.")
         diag_cols = ["SKU","Modo","FuenteTaxonomía","EndpointVTEX","JSON_count","URL","Observación"]
-        st.dataframe([{k: r.get(k, "") for k in diag_cols} for r in results], use_container_width=True)
+        st.dataframe(df[diag_cols], use_container_width=True)